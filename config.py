@@ -1,9 +1,12 @@
 # config.py
 import os
+import functools
+from dataclasses import dataclass
 from dotenv import load_dotenv
 
+@functools.lru_cache(maxsize=1)
 def load_env():
-    """載入並驗證環境變數"""
+    """載入並驗證環境變數（只會實際讀取 .env 一次，之後直接回傳快取結果）"""
     load_dotenv()
     env_vars = {
         "BOT_TOKEN": os.getenv("BOT_TOKEN"),
@@ -13,7 +16,13 @@ def load_env():
         "OLLAMA_BASE_URL": os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/api"),
         "OLLAMA_MODEL": os.getenv("OLLAMA_MODEL", "qwen2:7b"),
         "OLLAMA_VISION_MODEL": os.getenv("OLLAMA_VISION_MODEL", "llava:latest"),
-        "DEFAULT_PERSONA": os.getenv("DEFAULT_PERSONA")
+        "OLLAMA_KEEP_ALIVE": os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
+        "DEFAULT_PERSONA": os.getenv("DEFAULT_PERSONA"),
+        # Webhook 模式（選用）：設定 WEBHOOK_URL 後改由 Telegram 主動推送更新，否則維持輪詢
+        "WEBHOOK_URL": os.getenv("WEBHOOK_URL"),
+        "WEBHOOK_LISTEN": os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+        "WEBHOOK_PORT": os.getenv("WEBHOOK_PORT", "8443"),
+        "WEBHOOK_SECRET": os.getenv("WEBHOOK_SECRET"),
     }
     required = ["BOT_TOKEN", "OLLAMA_VISION_MODEL", "WEATHER_API_KEY", "NEWS_API_KEY", "DEFAULT_PERSONA"]
     missing = [key for key in required if not env_vars[key]]
@@ -32,9 +41,55 @@ WEATHER_CITY = env["WEATHER_CITY"]
 OLLAMA_BASE_URL = env["OLLAMA_BASE_URL"]
 DEFAULT_MODEL = env["OLLAMA_MODEL"]
 OLLAMA_VISION_MODEL = env["OLLAMA_VISION_MODEL"]
+OLLAMA_KEEP_ALIVE = env["OLLAMA_KEEP_ALIVE"]
 DEFAULT_PERSONA = env["DEFAULT_PERSONA"]
+WEBHOOK_URL = env["WEBHOOK_URL"]
+WEBHOOK_LISTEN = env["WEBHOOK_LISTEN"]
+WEBHOOK_PORT = int(env["WEBHOOK_PORT"])
+WEBHOOK_SECRET = env["WEBHOOK_SECRET"]
 
 MAX_ROUNDS = 12
 IMAGE_SIZE_LIMIT = 5 * 1024 * 1024
 PHOTO_PROMPT = "（專注地看著你分享的照片）哇，這張照片……"
-STICKER_PROMPT = "（看到你傳來的貼圖，溫柔地微笑著）這張貼圖真有趣，它讓我想到了……"
\ No newline at end of file
+STICKER_PROMPT = "（看到你傳來的貼圖，溫柔地微笑著）這張貼圖真有趣，它讓我想到了……"
+
+@dataclass(frozen=True)
+class Settings:
+    """所有設定的唯讀快照，供 `settings.XXX` 形式存取"""
+    BOT_TOKEN: str
+    NEWS_API_KEY: str
+    WEATHER_API_KEY: str
+    WEATHER_CITY: str
+    OLLAMA_BASE_URL: str
+    DEFAULT_MODEL: str
+    OLLAMA_VISION_MODEL: str
+    OLLAMA_KEEP_ALIVE: str
+    DEFAULT_PERSONA: str
+    WEBHOOK_URL: str | None
+    WEBHOOK_LISTEN: str
+    WEBHOOK_PORT: int
+    WEBHOOK_SECRET: str | None
+    MAX_ROUNDS: int
+    IMAGE_SIZE_LIMIT: int
+    PHOTO_PROMPT: str
+    STICKER_PROMPT: str
+
+settings = Settings(
+    BOT_TOKEN=BOT_TOKEN,
+    NEWS_API_KEY=NEWS_API_KEY,
+    WEATHER_API_KEY=WEATHER_API_KEY,
+    WEATHER_CITY=WEATHER_CITY,
+    OLLAMA_BASE_URL=OLLAMA_BASE_URL,
+    DEFAULT_MODEL=DEFAULT_MODEL,
+    OLLAMA_VISION_MODEL=OLLAMA_VISION_MODEL,
+    OLLAMA_KEEP_ALIVE=OLLAMA_KEEP_ALIVE,
+    DEFAULT_PERSONA=DEFAULT_PERSONA,
+    WEBHOOK_URL=WEBHOOK_URL,
+    WEBHOOK_LISTEN=WEBHOOK_LISTEN,
+    WEBHOOK_PORT=WEBHOOK_PORT,
+    WEBHOOK_SECRET=WEBHOOK_SECRET,
+    MAX_ROUNDS=MAX_ROUNDS,
+    IMAGE_SIZE_LIMIT=IMAGE_SIZE_LIMIT,
+    PHOTO_PROMPT=PHOTO_PROMPT,
+    STICKER_PROMPT=STICKER_PROMPT,
+)
\ No newline at end of file
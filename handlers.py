@@ -1,11 +1,9 @@
 # handlers.py
 import logging
-import ast
-import io
-import re
 import json
-import asyncio
+import orjson
 from collections import deque
+from cachetools import LRUCache
 from telegram import Update
 from telegram.constants import ParseMode, ChatAction
 from telegram.ext import ContextTypes
@@ -13,8 +11,39 @@ from telegram.ext import ContextTypes
 # 從我們自己的模組中匯入需要的東西
 from config import *
 from utils import (ask_ollama_once, ask_ollama_stream, stream_and_edit_message, 
-                   reply_safely, image_to_base64, extract_json_from_text, filter_stream)
-from tools import TOOL_REGISTRY, Tools
+                   reply_safely, image_to_base64, extract_json_from_text, filter_stream,
+                   strip_think)
+from tools import TOOL_REGISTRY, Tools, run_tools_parallel
+
+# 同一位使用者在同一個 persona 下重複傳同一張貼圖時，只需要跑一次視覺模型，之後直接沿用回覆。
+# 回覆是帶著該使用者的對話歷史生成的，可能提到私人內容，因此 key 必須包含 user_id，不能跨使用者共用
+_STICKER_CACHE = LRUCache(maxsize=1024)
+# 圖片的 base64 以 file_unique_id 快取，同一張圖再問一次時不必重新下載與編碼；
+# 以字串總長度 (約 64MB) 作為上限，避免大圖佔滿記憶體
+_IMAGE_B64_CACHE = LRUCache(maxsize=64 * 1024 * 1024, getsizeof=len)
+
+# --- 對話歷史 ---
+def history_to_messages(hist) -> list[dict]:
+    """
+    歷史紀錄以 (role, content) tuple 儲存以節省記憶體與持久化體積，
+    只在組 prompt 時才展開成 Ollama 需要的 dict；舊版存下來的 dict 直接沿用。
+    """
+    return [entry if isinstance(entry, dict) else {"role": entry[0], "content": entry[1]} for entry in hist]
+
+def build_prompt(ctx: ContextTypes.DEFAULT_TYPE, hist, user_content: str) -> list[dict]:
+    """
+    組出送給 Ollama 的訊息：persona + 歷史 + 本輪輸入。
+    文字與圖片共用同一個前綴順序，Ollama 才能重用上一輪已計算好的 KV cache，只處理新增的部分。
+    """
+    persona = ctx.user_data.get("persona", settings.DEFAULT_PERSONA)
+    return [{"role": "system", "content": persona}] + history_to_messages(hist) + [{"role": "user", "content": user_content}]
+
+def _dumps_tool_call(call: dict) -> str:
+    """把工具呼叫序列化回 JSON 字串；orjson 不支援超過 64 位元的整數 (例如很長的 ID)，這時改用 json"""
+    try:
+        return orjson.dumps(call).decode('utf-8')
+    except TypeError:
+        return json.dumps(call, ensure_ascii=False)
 
 # --- 主要對話處理 ---
 async def chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -23,75 +52,51 @@ async def chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """
     user_msg = update.message.text
     user_id = update.effective_user.id
-    logging.info(f"收到使用者 {user_id} 的訊息：{user_msg[:80]}...")
+    logging.info("收到使用者 %s 的訊息：%.80s...", user_id, user_msg)
     await ctx.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
 
     # 準備對話歷史與 Persona
     hist = ctx.user_data.setdefault("history", deque(maxlen=MAX_ROUNDS))
-    persona = ctx.user_data.get("persona", DEFAULT_PERSONA)
-    first_step_msgs = [{"role": "system", "content": persona}] + list(hist) + [{"role": "user", "content": user_msg}]
+    first_step_msgs = build_prompt(ctx, hist, user_msg)
     
     # 步驟一：呼叫模型，獲取初步回應
-    model_response = await ask_ollama_once(ctx, first_step_msgs)
-    logging.info(f"模型初步回應原文: {model_response}")
+    model_response = await ask_ollama_once(ctx, first_step_msgs, stop_after_json=True)
+    logging.info("模型初步回應原文: %s", model_response)
 
     # 步驟二：從回應中提取並解析工具請求
-    json_str = extract_json_from_text(model_response)
+    # 絕大多數是一般聊天，沒有 tool_name 字樣就不可能是工具請求，直接跳過掃描與解析
+    json_str = extract_json_from_text(model_response) if 'tool_name' in model_response else None
     tool_calls = []
     if json_str:
         try:
-            parsed_response = ast.literal_eval(json_str.replace("'", '"'))
+            # extract_json_from_text 保證回傳標準 JSON (單引號等寫法已在裡面正規化)，直接用 json.loads 解析
+            parsed_response = json.loads(json_str)
             if isinstance(parsed_response, list):
                 tool_calls = parsed_response
             elif isinstance(parsed_response, dict):
                 tool_calls.append(parsed_response)
         except Exception as e:
-            logging.error(f"最終解析失敗 ({e})，放棄工具呼叫。")
+            logging.error("最終解析失敗 (%s)，放棄工具呼叫。", e)
 
     final_reply = ""
     
     # 步驟三：核心決策 -> 根據有無工具請求，進入不同分支
     if isinstance(tool_calls, list) and tool_calls and all(isinstance(call, dict) and "tool_name" in call for call in tool_calls):
         
-        logging.info(f"偵測到有效工具請求: {[call.get('tool_name') for call in tool_calls]}")
+        logging.info("偵測到有效工具請求: %s", [call.get('tool_name') for call in tool_calls])
         
         # --- ✨ V20 核心改動：不再有 is_briefing_task 的特殊判斷 ---
         # --- 所有工具都走標準的 ReAct 循環 ---
         
-        tool_results, tasks_to_run, async_calls_map = [], [], []
-        for call in tool_calls:
-            tool_name = call.get("tool_name")
-            if tool_name not in TOOL_REGISTRY:
-                logging.warning(f"請求了未註冊的工具: {tool_name}")
-                continue
-
-            logging.info(f"執行工具: {tool_name}, 參數: {call.get('arguments', {})}")
-            tool_function = TOOL_REGISTRY[tool_name]
-            arguments = call.get("arguments", {})
-            kwargs = arguments.copy()
-
-            if asyncio.iscoroutinefunction(tool_function):
-                if tool_name == 'get_current_weather': 
-                    kwargs['ctx'] = ctx
-                    kwargs.setdefault('city', WEATHER_CITY)
-                tasks_to_run.append(tool_function(**kwargs))
-                async_calls_map.append(call)
-            else:
-                if tool_name in ['add_todo', 'list_todos', 'get_news_headlines']: 
-                    kwargs['ctx'] = ctx
-                result = tool_function(**kwargs)
-                tool_results.append({"tool_call": call, "result": result})
-
-        if tasks_to_run:
-            async_results = await asyncio.gather(*tasks_to_run)
-            for call, result in zip(async_calls_map, async_results):
-                tool_results.append({"tool_call": call, "result": result})
+        # 所有工具一次併發執行，總耗時取決於最慢的那一個，而不是全部相加
+        tool_results = await run_tools_parallel(ctx, tool_calls)
 
-        second_step_msgs = first_step_msgs
+        # 另建一個新的訊息列表承接工具結果，不再就地修改 first_step_msgs
+        tool_msgs = []
         for res in tool_results:
             tool_name = res['tool_call'].get('tool_name')
             tool_result_str = str(res['result'])
-            logging.info(f"工具 {tool_name} 執行結果: {tool_result_str[:150]}...")
+            logging.info("工具 %s 執行結果: %.150s...", tool_name, tool_result_str)
             
             # ✨ V20 核心改動：為新聞工具建立專屬的「最終烹飪指令」
             final_instruction = ""
@@ -114,11 +119,12 @@ async def chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                     f"【工具數據】\n---\n{tool_result_str}\n---"
                 )
 
-            second_step_msgs.extend([
-                {"role": "assistant", "content": json.dumps(res['tool_call'], ensure_ascii=False)},
+            tool_msgs.extend([
+                {"role": "assistant", "content": _dumps_tool_call(res['tool_call'])},
                 {"role": "tool", "content": final_instruction}
             ])
         
+        second_step_msgs = first_step_msgs + tool_msgs
         raw_generator = ask_ollama_stream(ctx, second_step_msgs)
         filtered_generator = filter_stream(raw_generator)
         final_reply = await stream_and_edit_message(update, ctx, filtered_generator)
@@ -126,11 +132,9 @@ async def chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     else:
         # --- 分支 C：普通聊天 ---
         logging.info("未偵測到有效工具請求，當作一般對話處理。")
+        # 回應已經完整拿到了，一次產出即可，不再人為切片 + sleep 模擬打字
         async def text_generator(text):
-            cleaned_text = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL).strip()
-            for i in range(0, len(cleaned_text), 10):
-                yield cleaned_text[i:i+10]
-                await asyncio.sleep(0.01)
+            yield strip_think(text)
         
         response_generator = text_generator(model_response)
         final_reply = await stream_and_edit_message(update, ctx, response_generator)
@@ -139,43 +143,57 @@ async def chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not final_reply: 
         final_reply = "（我好像有點不知道該說什麼了...）"
     
-    hist.append({"role": "user", "content": user_msg})
-    hist.append({"role": "assistant", "content": final_reply})
+    hist.append(("user", user_msg))
+    hist.append(("assistant", final_reply))
 
 # --- 圖片/貼圖處理 ---
 async def photo_or_sticker_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, is_sticker: bool):
-    file_id, file_size = (None, None)
+    file_id, file_size, file_unique_id = (None, None, None)
     if is_sticker:
         sticker = update.message.sticker
         if sticker.is_animated or sticker.is_video: await update.message.reply_text("抱歉，我不支援動態或影片貼圖喔～"); return
-        file_id, file_size = sticker.file_id, sticker.file_size
+        file_id, file_size, file_unique_id = sticker.file_id, sticker.file_size, sticker.file_unique_id
+        sticker_key = (update.effective_user.id, file_unique_id, ctx.user_data.get("persona", settings.DEFAULT_PERSONA))
     else:
         photo = update.message.photo[-1]
-        file_id, file_size = photo.file_id, photo.file_size
+        file_id, file_size, file_unique_id = photo.file_id, photo.file_size, photo.file_unique_id
     
     if file_size and file_size > settings.IMAGE_SIZE_LIMIT: await update.message.reply_text(f"⚠️ 檔案過大"); return
+
+    hist = ctx.user_data.setdefault("history", deque(maxlen=settings.MAX_ROUNDS))
+    user_msg_for_hist = "(傳送了一張貼圖)" if is_sticker else "(傳送了一張照片)"
+    if is_sticker and sticker_key in _STICKER_CACHE:
+        # 快取命中：不必下載、編碼，也不必再跑一次視覺模型
+        cleaned_reply = _STICKER_CACHE[sticker_key]
+        hist.append(("user", user_msg_for_hist))
+        hist.append(("assistant", cleaned_reply))
+        await reply_safely(update, cleaned_reply)
+        return
+
     await ctx.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
 
     try:
-        tg_file = await ctx.bot.get_file(file_id)
-        with io.BytesIO() as bio:
-            await tg_file.download_to_memory(out=bio); bio.seek(0)
-            image_b64 = image_to_base64(bio.getvalue())
+        image_b64 = _IMAGE_B64_CACHE.get(file_unique_id)
+        if image_b64 is None:
+            tg_file = await ctx.bot.get_file(file_id)
+            # 直接下載成 bytearray 再編碼，省去 BytesIO 包裝與 getvalue() 的額外複製
+            raw = await tg_file.download_as_bytearray()
+            image_b64 = image_to_base64(raw)
+            del raw
+            _IMAGE_B64_CACHE[file_unique_id] = image_b64
         
-        hist = ctx.user_data.setdefault("history", deque(maxlen=settings.MAX_ROUNDS))
-        persona = ctx.user_data.get("persona", settings.DEFAULT_PERSONA)
         prompt = settings.STICKER_PROMPT if is_sticker else settings.PHOTO_PROMPT
-        user_msg_for_hist = "(傳送了一張貼圖)" if is_sticker else "(傳送了一張照片)"
-        
-        msgs = [{"role": "system", "content": persona}] + list(hist) + [{"role": "user", "content": prompt}]
+        msgs = build_prompt(ctx, hist, prompt)
         reply = await ask_ollama_once(ctx, msgs, image_b64=image_b64)
-        cleaned_reply = re.sub(r'<think>.*?</think>\s*', '', reply, flags=re.DOTALL).strip()
+        cleaned_reply = strip_think(reply)
+        if is_sticker and cleaned_reply and not cleaned_reply.startswith("⚠️"): # 不快取 API 錯誤訊息
+            _STICKER_CACHE[sticker_key] = cleaned_reply
         
-        hist.append({"role": "user", "content": user_msg_for_hist})
-        hist.append({"role": "assistant", "content": cleaned_reply})
+        hist.append(("user", user_msg_for_hist))
+        hist.append(("assistant", cleaned_reply))
         await reply_safely(update, cleaned_reply)
     except Exception as e:
-        logging.error(f"處理圖片/貼圖時出錯: {e}"); await update.message.reply_text("⚠️ 處理圖片時發生錯誤。")
+        logging.error("處理圖片/貼圖時出錯: %s", e); await update.message.reply_text("⚠️ 處理圖片時發生錯誤。")
 
 async def photo_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE): await photo_or_sticker_handler(update, ctx, is_sticker=False)
 async def sticker_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE): await photo_or_sticker_handler(update, ctx, is_sticker=True)
@@ -1,27 +1,46 @@
 # main.py (修正版)
 import logging
 import os, sys
+from urllib.parse import urlparse
 import asyncio
 import aiohttp
+try:
+    import uvloop # 選用：libuv 實作的事件迴圈，Windows 上沒有
+except ImportError:
+    uvloop = None
 from telegram.ext import (
-    Application, ApplicationBuilder, CommandHandler, MessageHandler, filters, PicklePersistence
+    Application, ApplicationBuilder, CommandHandler, MessageHandler, filters
 )
 
 # 從我們自己的模組中匯入所有需要的東西
-from config import BOT_TOKEN, DEFAULT_PERSONA
+from config import BOT_TOKEN, DEFAULT_PERSONA, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET
 from handlers import (
     start, chat, photo_handler, sticker_handler, BotCommands
 )
 from tools import TOOL_REGISTRY, Tools # 雖然 main 不直接用，但 import 進來確保模組可被找到
+from persistence import SQLitePersistence
 
 # --- 應用程式生命週期函式 ---
 async def post_init(application: Application):
     """應用程式啟動後執行的非同步函式"""
     #application.bot_data["aiohttp_session"] = aiohttp.ClientSession()
     #logging.info("aiohttp.ClientSession 已建立並注入 bot_data。")
-    application.aiohttp_session = aiohttp.ClientSession()
+    # ✨ 所有工具 (天氣、新聞、搜尋) 與 Ollama 共用同一個連線池：
+    # 限制總連線數，並快取 DNS 解析結果，避免每次呼叫都重新查詢。
+    # 不設每台主機的上限：每個 Ollama 回覆都是佔住同一台主機的長串流，上限太低會讓後來的對話卡在連線池
+    # 工具呼叫預設最多等 15 秒 (連線 5 秒)，外部 API 卡住時不會拖住整個回覆；Ollama 串流另有自己的逾時設定
+    connector = aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, enable_cleanup_closed=True)
+    timeout = aiohttp.ClientTimeout(total=15, connect=5)
+    application.aiohttp_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
     logging.info("aiohttp.ClientSession 已建立並直接附加到 application 物件。")
 
+    # ✨ Python 3.12+：使用 eager task factory，工具在第一次 await 前（例如快取命中）就能直接完成，
+    # 不必先排進事件迴圈等待下一輪；舊版 Python 維持預設行為
+    eager_task_factory = getattr(asyncio, "eager_task_factory", None)
+    if eager_task_factory is not None:
+        asyncio.get_running_loop().set_task_factory(eager_task_factory)
+        logging.info("已啟用 asyncio.eager_task_factory。")
+
 
 async def post_shutdown(application: Application):
     """應用程式關閉前執行的非同步函式"""
@@ -29,14 +48,17 @@ async def post_shutdown(application: Application):
     if hasattr(application, 'aiohttp_session') and not application.aiohttp_session.closed:
         await application.aiohttp_session.close()
         logging.info("aiohttp.ClientSession 已關閉。")
-    # ✨ 在關閉時明確地儲存一次資料，並印出日誌
-    logging.info("正在執行 post_shutdown，嘗試儲存持久化資料...")
-    await application.update_persistence()
-    logging.info("持久化資料儲存完畢。")
+    # 持久化資料不必在這裡儲存：PTB 關閉時已經寫回最後一次變動，並呼叫 flush() 關閉 SQLite 連線，
+    # 這裡再呼叫 update_persistence() 只會重新開啟連線，且之後不會再被關閉
 
 def main():
     """主函式，設定並運行機器人"""
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    # ✨ 在 Application 建立事件迴圈之前換成 uvloop，所有 socket 與計時器排程都走 libuv
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logging.info("已啟用 uvloop 事件迴圈。")
     
     # 提醒使用者檢查 Persona 設定
     if not DEFAULT_PERSONA or "tool_name" not in DEFAULT_PERSONA:
@@ -46,13 +68,16 @@ def main():
         print("請確認您已將最新的『工具人 Persona』複製到 .env 檔案中！")
         print("="*50 + "\n")
 
-    # (持久化設定的程式碼)
-    persistence_filepath = "data/lala_bot_data.pkl"
+    # (持久化設定的程式碼) 每位使用者一列，只寫回有變動的使用者
+    persistence_filepath = "data/lala_bot_data.sqlite3"
     persistence_dir = os.path.dirname(persistence_filepath)
     if persistence_dir:
         os.makedirs(persistence_dir, exist_ok=True)
-    logging.info(f"持久化檔案將儲存於: {os.path.abspath(persistence_filepath)}")
-    persistence = PicklePersistence(filepath=persistence_filepath)
+    logging.info("持久化檔案將儲存於: %s", os.path.abspath(persistence_filepath))
+    persistence = SQLitePersistence(
+        filepath=persistence_filepath,
+        legacy_pickle_path="data/lala_bot_data.pkl", # 首次啟動時從舊的 pickle 檔匯入
+    )
 
 
 
@@ -76,8 +101,20 @@ def main():
     app.add_handler(MessageHandler(filters.Sticker.ALL, sticker_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat))
 
-    logging.info("Bot 開始輪詢 (模組化 + 函式呼叫 + 持久化模式)...")
-    app.run_polling()
+    if WEBHOOK_URL:
+        # ✨ Webhook 模式：由 Telegram 主動推送更新，閒置時不必持續發出 getUpdates 長輪詢
+        # TLS 交給前端的反向代理 (例如 nginx) 處理，這裡只監聽本地路徑
+        logging.info("Bot 以 Webhook 模式啟動，監聽 %s:%s ...", WEBHOOK_LISTEN, WEBHOOK_PORT)
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        logging.info("Bot 開始輪詢 (模組化 + 函式呼叫 + 持久化模式)...")
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,145 @@
+# persistence.py
+import asyncio
+import logging
+import os
+import pickle
+import sqlite3
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+class SQLitePersistence(BasePersistence):
+    """
+    以 SQLite 儲存 user_data 的持久化後端。
+    每位使用者佔一列，PTB 只會對有變動的使用者呼叫 update_user_data，
+    因此每次寫入都只處理變動的那幾列，而不是像 PicklePersistence 一樣重寫整個檔案。
+    """
+
+    def __init__(self, filepath: str, legacy_pickle_path: str | None = None, update_interval: float = 60):
+        # 這個機器人只用到 user_data，其餘資料不需要持久化
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.filepath = filepath
+        self.legacy_pickle_path = legacy_pickle_path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = asyncio.Lock()
+
+    # --- 同步的資料庫操作，一律透過 _run 丟到執行緒中執行 ---
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filepath, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._conn.commit()
+        return self._conn
+
+    def _load_users(self) -> dict:
+        conn = self._connect()
+        rows = conn.execute("SELECT user_id, data FROM users").fetchall()
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone() is None:
+            if rows:
+                self._mark_legacy_imported() # 已有資料的舊資料庫：匯入早就做過了
+            else:
+                return self._import_legacy_pickle()
+        return {user_id: pickle.loads(data) for user_id, data in rows}
+
+    def _mark_legacy_imported(self):
+        conn = self._connect()
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_imported', '1')")
+        conn.commit()
+
+    def _import_legacy_pickle(self) -> dict:
+        """
+        第一次啟動時從舊版 PicklePersistence 檔案匯入 user_data。
+        匯入後在 meta 表留下記號，之後即使使用者資料全被刪光，也不會再把舊資料匯回來。
+        """
+        if not self.legacy_pickle_path or not os.path.exists(self.legacy_pickle_path):
+            self._mark_legacy_imported()
+            return {}
+        try:
+            with open(self.legacy_pickle_path, "rb") as f:
+                user_data = pickle.load(f).get("user_data", {})
+        except Exception as e:
+            logging.error("無法讀取舊版持久化檔案 %s: %s", self.legacy_pickle_path, e)
+            return {}
+        self._upsert_many([(user_id, pickle.dumps(data, pickle.HIGHEST_PROTOCOL)) for user_id, data in user_data.items()])
+        self._mark_legacy_imported()
+        logging.info("已從 %s 匯入 %d 位使用者的資料。", self.legacy_pickle_path, len(user_data))
+        return dict(user_data)
+
+    def _upsert_many(self, rows: list[tuple[int, bytes]]):
+        conn = self._connect()
+        conn.executemany(
+            "INSERT INTO users (user_id, data) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+            rows,
+        )
+        conn.commit()
+
+    def _delete(self, user_id: int):
+        conn = self._connect()
+        conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        conn.commit()
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def _run(self, func, *args):
+        async with self._lock:
+            return await asyncio.to_thread(func, *args)
+
+    # --- user_data ---
+    async def get_user_data(self) -> dict:
+        return await self._run(self._load_users)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        # 在事件迴圈上序列化，確保寫入的是當下一致的快照
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        await self._run(self._upsert_many, [(user_id, blob)])
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._run(self._delete, user_id)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await self._run(self._close)
+
+    # --- 未使用的資料類型 (store_data 已關閉，這裡只滿足介面) ---
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
@@ -0,0 +1,8 @@
+# tests/conftest.py
+import os
+import sys
+
+# 測試直接匯入專案根目錄的模組；config 在匯入時就會檢查必要的環境變數，先填入假值
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for key in ("BOT_TOKEN", "WEATHER_API_KEY", "NEWS_API_KEY", "DEFAULT_PERSONA"):
+    os.environ.setdefault(key, "test")
@@ -0,0 +1,174 @@
+# tests/test_utils.py
+import asyncio
+import json
+import random
+
+import pytest
+
+import utils
+
+from utils import (extract_json_from_text, filter_stream, strip_think, _ToolCallWatcher,
+                   _match_brackets, _single_to_double_quotes, _is_valid_mdv2)
+
+
+# --- _match_brackets ---
+@pytest.mark.parametrize("text, expected", [
+    ('a {"x": [1, "]"]} b', {8: 15, 2: 16}),   # 字串內的括號不算
+    ("{'a': 'x}'}", {0: 10}),                    # Python 風格的單引號字串
+    ("[Lala's] {}", {0: 7, 9: 10}),              # 散文裡的撇號不是字串開頭
+    ('{"a": "x\n}', {0: 9}),                     # 沒閉合的字串在換行處結束
+    ('{]}', {}),                                 # 不成對的開括號被丟棄
+    ('no brackets', {}),
+])
+def test_match_brackets(text, expected):
+    assert _match_brackets(text) == expected
+
+
+# --- _single_to_double_quotes ---
+@pytest.mark.parametrize("text, expected", [
+    ("{'a': 'b'}", '{"a": "b"}'),
+    ("{'a': 'it\\'s'}", '{"a": "it\'s"}'),           # \' 改回單純的撇號
+    ("{'a': \"it's\"}", '{"a": "it\'s"}'),           # 雙引號字串內的撇號維持原樣
+    ("{'a': 'say \"hi\"'}", '{"a": "say \\"hi\\""}'), # 單引號字串內的雙引號要跳脫
+])
+def test_single_to_double_quotes(text, expected):
+    assert _single_to_double_quotes(text) == expected
+    json.loads(expected)
+
+
+# --- extract_json_from_text ---
+@pytest.mark.parametrize("text, expected", [
+    ('{"tool_name": "get_current_time"}', {"tool_name": "get_current_time"}),
+    ('好的～ {"tool_name": "search_web", "arguments": {"query": "a}b"}} 馬上查',
+     {"tool_name": "search_web", "arguments": {"query": "a}b"}}),
+    ('<think>{"tool_name": "nope"}</think>{"tool_name": "a"}', {"tool_name": "a"}),
+    ('{"tool_name": "a"} 然後 {"tool_name": "b"}', [{"tool_name": "a"}, {"tool_name": "b"}]),
+    ("{'tool_name': 'add_todo', 'arguments': {'item': 'it\\'s [x]'}}",
+     {"tool_name": "add_todo", "arguments": {"item": "it's [x]"}}),
+    ("{'tool_name': 'x', 'arguments': {'flag': True, 'v': None}}",
+     {"tool_name": "x", "arguments": {"flag": True, "v": None}}),
+    ('[Lala\'s note] {"tool_name": "get_current_time"}', {"tool_name": "get_current_time"}),
+    ('純聊天，沒有 JSON', None),
+    ('{不是 JSON}', None),
+])
+def test_extract_json_from_text(text, expected):
+    result = extract_json_from_text(text)
+    if expected is None:
+        assert result is None
+    else:
+        assert json.loads(result) == expected
+
+
+def test_extract_json_from_text_is_linear_on_bracket_heavy_text():
+    # 逐字重試 raw_decode 的舊寫法在這裡會退化成 O(n²)；單次括號配對應該瞬間完成
+    text = "[" * 20000 + '{"tool_name": "a"}'
+    assert json.loads(extract_json_from_text(text)) == {"tool_name": "a"}
+
+
+def test_extract_json_from_text_decodes_only_the_candidate(monkeypatch):
+    # 對整段原文 raw_decode 時，每次失敗的 JSONDecodeError 都要重數前綴的行數而退化成 O(n²)；
+    # 改為確認每次解碼只拿到成對括號的那一段
+    seen = []
+    raw_decode = json.JSONDecoder.raw_decode
+    def spy(self, s, idx=0):
+        seen.append(len(s) - idx)
+        return raw_decode(self, s, idx)
+    monkeypatch.setattr(json.JSONDecoder, "raw_decode", spy)
+    text = "{a}\n" * 1000 + '{"tool_name": "a"}'
+    result = extract_json_from_text(text)
+    assert len(seen) == 1001 and max(seen) == len('{"tool_name": "a"}')
+    monkeypatch.undo()
+    assert json.loads(result) == {"tool_name": "a"}
+
+
+def test_extract_json_from_text_tries_lenient_parsing_once_per_nest(monkeypatch):
+    # 巢狀的 Python 風格候選只在最外層走一次備援解析，內層不再重複解析整段內容
+    calls = []
+    monkeypatch.setattr(utils, "_loads_lenient", lambda candidate: calls.append(candidate))
+    text = "{'tool_name' " * 100 + "x" * 1000 + "}" * 100
+    assert extract_json_from_text(text) is None
+    assert calls == [text]
+
+
+def test_extract_json_from_text_skips_lenient_parsing_for_plain_code(monkeypatch):
+    calls = []
+    monkeypatch.setattr(utils, "_loads_lenient", lambda candidate: calls.append(candidate))
+    assert extract_json_from_text('if (x) { y[i] = z; }\n' * 100) is None
+    assert calls == []
+
+
+# --- filter_stream ---
+async def _collect(chunks):
+    async def gen():
+        for chunk in chunks:
+            yield chunk
+    return ''.join([part async for part in filter_stream(gen())])
+
+
+def _random_chunks(text, rng):
+    cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(0, 10))))
+    return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+
+@pytest.mark.parametrize("text", [
+    "你好呀！",
+    "  <think>想一想 <b> </th</think>\n\n  答案是 42。  ",
+    "前言 <think>a</think> 中間 <think>b</think>\n結尾\n",
+    "<think>沒有閉合的思考",
+    "a < b 且 </ 不是標籤 <thin",
+    "",
+])
+def test_filter_stream_matches_strip_think_for_any_chunking(text):
+    # 與 strip_think 相同；唯一差別是沒有閉合的思考區塊會整段捨棄，而不是原樣保留
+    unclosed = '<think>' in text and '</think>' not in text
+    expected = strip_think(text.split('<think>')[0] if unclosed else text)
+    rng = random.Random(text)
+    for _ in range(200):
+        chunks = _random_chunks(text, rng) if len(text) > 1 else [text]
+        assert asyncio.run(_collect(chunks)) == expected
+
+
+# --- _is_valid_mdv2 ---
+@pytest.mark.parametrize("text, expected", [
+    ("你好", True),
+    ("a\\.b", True),
+    ("*粗體* 與 _斜體_", True),
+    ("`a.b` 程式碼內不用跳脫", True),
+    ("a.b", False),      # 保留字元沒有跳脫
+    ("*未閉合", False),
+    ("`未閉合", False),
+    ("結尾的反斜線\\", False),
+])
+def test_is_valid_mdv2(text, expected):
+    assert _is_valid_mdv2(text) is expected
+
+
+# --- _ToolCallWatcher ---
+def _feed_all(chunks):
+    """模擬 ask_ollama_once：回傳在第幾個片段提早結束，沒有提早結束則回傳 None"""
+    watcher = _ToolCallWatcher()
+    for i, chunk in enumerate(chunks):
+        done = watcher.feed(chunk)
+        if done:
+            return i
+        if done is False:
+            return None
+    return None
+
+
+def test_tool_call_watcher_stops_after_complete_call():
+    chunks = ['<think>嗯 {x} ]', '</think>\n\n{"tool_name":', ' "get_current_time"}', '\n\n', '好的']
+    assert _feed_all(chunks) == 4
+
+
+def test_tool_call_watcher_handles_split_think_tag():
+    chunks = ['<th', 'ink>a', '</think>{"tool_name":"t"}', 'x']
+    assert _feed_all(chunks) == 3
+
+
+def test_tool_call_watcher_keeps_generating_for_possible_second_call():
+    assert _feed_all(['{"tool_name":"a"}', ' {"tool_name":"b"}', ' ok']) is None
+
+
+def test_tool_call_watcher_ignores_plain_chat():
+    assert _feed_all(['你好', ' {"tool_name":"a"}', ' x']) is None
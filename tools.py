@@ -1,74 +1,138 @@
 # tools.py
 import logging
+import asyncio
+import weakref
 from datetime import datetime
-import pytz
+from zoneinfo import ZoneInfo
 import aiohttp
-from duckduckgo_search import DDGS
-from newsapi import NewsApiClient
+from cachetools import TTLCache
+from selectolax.lexbor import LexborHTMLParser
 from telegram.ext import ContextTypes
 
 # 從 config 模組匯入我們需要的設定
-from config import NEWS_API_KEY, WEATHER_API_KEY
+from config import NEWS_API_KEY, WEATHER_API_KEY, WEATHER_CITY
+
+NEWS_API_URL = "https://newsapi.org/v2/everything"
+DDG_HTML_URL = "https://html.duckduckgo.com/html/"
+# 相同關鍵字的新聞在 5 分鐘內直接使用快取，省下 NewsAPI 的往返與額度
+_NEWS_CACHE = TTLCache(maxsize=256, ttl=300)
+# 搜尋結果同樣快取 5 分鐘，重複的查詢不必再打 DuckDuckGo
+_SEARCH_CACHE = TTLCache(maxsize=256, ttl=300)
+# 天氣資料幾分鐘才更新一次，以英文城市名為 key 快取 5 分鐘；
+# 每個城市一把鎖，合併同時間的重複查詢（沒有人在等時鎖會自動被回收）
+_WEATHER_CACHE = TTLCache(maxsize=64, ttl=300)
+_WEATHER_LOCKS: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+_TZ_TAIPEI = ZoneInfo('Asia/Taipei')
+
+# 中文城市名 -> OpenWeather 查詢用的英文名
+_CITY_MAP = {
+    "台北": "Taipei",
+    "桃園": "Taoyuan",
+    "台中": "Taichung",
+    "台南": "Tainan",
+    "高雄": "Kaohsiung",
+    "洛杉磯": "Los Angeles",
+    "東京": "Tokyo",
+}
+
+def _node_text(node) -> str:
+    """取出節點文字並合併空白；不用 text(strip=True)，它會把 <b> 標出的關鍵字和前後的字黏在一起"""
+    return " ".join(node.text().split())
 
 class Tools:
-    CITY_MAP = {
-        "台北": "Taipei",
-        "桃園": "Taoyuan",
-        "台中": "Taichung",
-        "台南": "Tainan",
-        "高雄": "Kaohsiung",
-        "洛杉磯": "Los Angeles",
-        "東京": "Tokyo",
-    }
     @staticmethod
     def get_current_time():
-        tz = pytz.timezone('Asia/Taipei')
-        return datetime.now(tz).strftime("%Y年%m月%d日 %A %H:%M")
+        return datetime.now(_TZ_TAIPEI).strftime("%Y年%m月%d日 %A %H:%M")
 
     @staticmethod
     async def get_current_weather(ctx: ContextTypes.DEFAULT_TYPE, city: str):
-        # ✨ 在查詢前，先嘗試轉換成英文名
-        city_en = Tools.CITY_MAP.get(city, city) # 如果在字典裡，就用英文名；否則用原文
+        # ✨ 在查詢前，先正規化 (去空白、「臺」->「台」、去掉結尾的「市」) 再嘗試轉換成英文名，
+        # 讓「台北市」、「 臺北 」等寫法都能命中對照表與天氣快取
+        city_key = city.strip().replace("臺", "台").removesuffix("市")
+        city_en = _CITY_MAP.get(city_key) or city_key # 如果在字典裡，就用英文名；否則用原文
         session: aiohttp.ClientSession = ctx.application.aiohttp_session
         if not WEATHER_API_KEY: return "（天氣功能未設定 API Key）"
-        url = f"http://api.openweathermap.org/data/2.5/weather?q={city_en}&appid={WEATHER_API_KEY}&units=metric&lang=zh_tw"
-        try:
-            async with session.get(url) as r:
-                data = await r.json()
-                if r.status == 200: 
-                    description = data['weather'][0]['description']
-                    temp = data['main']['temp']
-                    return f"地點：{city}, 天氣：{description}, 氣溫：{temp}°C"
-                else: 
-                    error_message = data.get('message', '未知錯誤')
-                    logging.error(f"天氣 API 錯誤 ({r.status}) for city '{city_en}': {error_message}")
-                    return f"（無法取得 {city} 的天氣資訊：{error_message}）"
-        except Exception as e: 
-            logging.error(f"獲取天氣失敗: {e}")
-            return "（獲取天氣時發生網路或解析錯誤）"
-        
+        cache_key = city_en.lower()
+        cached = _WEATHER_CACHE.get(cache_key)
+        if cached is None:
+            lock = _WEATHER_LOCKS.get(cache_key)
+            if lock is None:
+                lock = _WEATHER_LOCKS[cache_key] = asyncio.Lock()
+            # 同一城市同時只讓一個請求打到 OpenWeather，其餘的等它完成後直接讀快取
+            async with lock:
+                cached = _WEATHER_CACHE.get(cache_key)
+                if cached is None:
+                    url = f"http://api.openweathermap.org/data/2.5/weather?q={city_en}&appid={WEATHER_API_KEY}&units=metric&lang=zh_tw"
+                    try:
+                        async with session.get(url) as r:
+                            data = await r.json()
+                            if r.status != 200:
+                                error_message = data.get('message', '未知錯誤')
+                                logging.error("天氣 API 錯誤 (%s) for city '%s': %s", r.status, city_en, error_message)
+                                return f"（無法取得 {city} 的天氣資訊：{error_message}）"
+                            cached = (data['weather'][0]['description'], data['main']['temp'])
+                            _WEATHER_CACHE[cache_key] = cached
+                    except Exception as e: 
+                        logging.error("獲取天氣失敗: %s", e)
+                        return "（獲取天氣時發生網路或解析錯誤）"
+
+        description, temp = cached
+        return f"地點：{city}, 天氣：{description}, 氣溫：{temp}°C"
+
     @staticmethod
-    def search_web(query: str):
+    async def search_web(ctx: ContextTypes.DEFAULT_TYPE, query: str):
+        """透過共用的 aiohttp session 查詢 DuckDuckGo HTML 版，取前三筆結果"""
+        cache_key = query.strip().lower()
+        cached = _SEARCH_CACHE.get(cache_key)
+        if cached is not None: return cached
+        session: aiohttp.ClientSession = ctx.application.aiohttp_session
         try:
-            with DDGS() as ddgs: results = [r for r in ddgs.text(query, max_results=3)]
+            async with session.post(DDG_HTML_URL, data={"q": query}) as r:
+                if r.status != 200:
+                    logging.error("網路搜尋錯誤 (%s) for query '%s'", r.status, query)
+                    return "抱歉，搜尋時發生錯誤。"
+                html = await r.text()
+
+            results = []
+            for node in LexborHTMLParser(html).css("div.result:not(.result--ad)"):
+                title = node.css_first("a.result__a")
+                if title is None: continue
+                snippet = node.css_first(".result__snippet")
+                results.append({"title": _node_text(title), "body": _node_text(snippet) if snippet else ""})
+                if len(results) == 3: break
+
             if not results: return "抱歉，網路上找不到相關資訊。"
             formatted = [f"標題: {r['title']}\n摘要: {r.get('body', '')}\n---" for r in results]
-            return "\n".join(formatted)
-        except Exception as e: logging.error(f"網路搜尋失敗: {e}"); return "抱歉，搜尋時發生錯誤。"
+            result = "\n".join(formatted)
+            _SEARCH_CACHE[cache_key] = result
+            return result
+        except Exception as e: logging.error("網路搜尋失敗: %s", e); return "抱歉，搜尋時發生錯誤。"
 
     @staticmethod
-    def get_news_headlines(ctx: ContextTypes.DEFAULT_TYPE, query: str):
-        """根據指定的關鍵字，獲取新聞文章列表並進行去重。"""
+    async def get_news_headlines(ctx: ContextTypes.DEFAULT_TYPE, query: str):
+        """根據指定的關鍵字，透過共用的 aiohttp session 獲取新聞文章列表並進行去重。"""
         if not NEWS_API_KEY: return "抱歉，新聞功能未設定 API Key。"
+        session: aiohttp.ClientSession = ctx.application.aiohttp_session
+        cache_key = (query.strip().lower(), "zh")
         try:
-            newsapi = NewsApiClient(api_key=NEWS_API_KEY)
-            # ✨ 總是用 get_everything，query 由模型決定
-            headlines = newsapi.get_everything(q=query, language='zh', sort_by='relevancy', page_size=10)
-            
-            articles = headlines.get('articles', [])
+            articles = _NEWS_CACHE.get(cache_key)
+            if articles is None:
+                params = {"q": query, "language": "zh", "sortBy": "relevancy", "pageSize": 10}
+                headers = {"X-Api-Key": NEWS_API_KEY}
+                # ✨ 總是用 /v2/everything，query 由模型決定
+                async with session.get(NEWS_API_URL, params=params, headers=headers) as r:
+                    data = await r.json()
+                    if r.status != 200:
+                        error_message = data.get('message', '未知錯誤')
+                        logging.error("新聞 API 錯誤 (%s) for query '%s': %s", r.status, query, error_message)
+                        return f"抱歉，查詢新聞時發生錯誤: {error_message}"
+                articles = data.get('articles', [])
+                _NEWS_CACHE[cache_key] = articles
+
             if not articles: return f"找不到關於「{query}」的新聞。"
-            
-            # (新聞去重邏輯不變)
+
+            # (新聞去重邏輯不變，快取命中時每位使用者仍只會看到沒看過的新聞；
+            #  await 之後不再讓出事件迴圈，因此不需要額外加鎖)
             seen_urls = ctx.user_data.setdefault("seen_news_urls", set())
             new_articles = []
             for article in articles:
@@ -76,17 +140,15 @@ class Tools:
                 if url and url not in seen_urls:
                     new_articles.append(article)
                     seen_urls.add(url)
-            
+
             if not new_articles: return "抱歉，目前沒有更多關於這個主題的新聞了耶～"
-            
+
             # ✨ 回傳精簡後的文章物件，只包含摘要所需內容
             return [{"title": a.get("title"), "description": a.get("description"), "url": a.get("url")} for a in new_articles]
         except Exception as e:
-            logging.error(f"獲取新聞失敗: {e}")
+            logging.error("獲取新聞失敗: %s", e)
             return f"抱歉，查詢新聞時發生錯誤: {e}"
 
-
-        
     @staticmethod
     def add_todo(ctx: ContextTypes.DEFAULT_TYPE, item: str):
         todos = ctx.user_data.setdefault("todos", [])
@@ -115,4 +177,46 @@ TOOL_REGISTRY = {
     "add_todo": Tools.add_todo,
     "list_todos": Tools.list_todos,
     "recommend_music": Tools.recommend_music,
-}
\ No newline at end of file
+}
+
+# 需要 ctx (共用 session 或 user_data) 的工具
+_TOOLS_NEEDING_CTX = {"get_current_weather", "get_news_headlines", "search_web", "add_todo", "list_todos"}
+
+async def _run_tool(ctx: ContextTypes.DEFAULT_TYPE, call: dict):
+    """
+    執行單一工具，例外轉成錯誤訊息回傳，不影響其他工具。
+    網路工具都是原生協程；剩下的同步工具只花微秒，且會讀寫 user_data，直接在事件迴圈上呼叫
+    (丟到執行緒反而多一次切換，還可能與持久化同時存取同一個 dict)。
+    """
+    tool_name = call.get("tool_name")
+    try:
+        tool_function = TOOL_REGISTRY[tool_name]
+        # 模型常對無參數的工具給出 "arguments": null 或一個字串，一律當成沒有參數
+        arguments = call.get("arguments")
+        kwargs = dict(arguments) if isinstance(arguments, dict) else {}
+        if tool_name in _TOOLS_NEEDING_CTX:
+            kwargs['ctx'] = ctx
+        if tool_name == 'get_current_weather':
+            kwargs.setdefault('city', WEATHER_CITY)
+        if asyncio.iscoroutinefunction(tool_function):
+            return await tool_function(**kwargs)
+        return tool_function(**kwargs)
+    except Exception as e:
+        logging.error("工具 %s 執行失敗: %s", tool_name, e)
+        return f"（工具 {tool_name} 執行失敗：{e}）"
+
+async def run_tools_parallel(ctx: ContextTypes.DEFAULT_TYPE, calls: list[dict]) -> list[dict]:
+    """
+    併發執行模型要求的所有工具呼叫，依呼叫順序回傳 [{"tool_call": ..., "result": ...}]。
+    未註冊的工具會被略過。
+    """
+    running = []
+    async with asyncio.TaskGroup() as tg:
+        for call in calls:
+            tool_name = call.get("tool_name")
+            if not isinstance(tool_name, str) or tool_name not in TOOL_REGISTRY:
+                logging.warning("請求了未註冊的工具: %s", tool_name)
+                continue
+            logging.info("執行工具: %s, 參數: %s", tool_name, call.get('arguments', {}))
+            running.append((call, tg.create_task(_run_tool(ctx, call))))
+    return [{"tool_call": call, "result": task.result()} for call, task in running]
@@ -4,18 +4,57 @@ import base64
 import aiohttp
 import telegram
 import asyncio
+import contextlib
 import json
+import ast
 import re
+import orjson
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
-from telegram.error import Forbidden, BadRequest
+from telegram.error import Forbidden, BadRequest, RetryAfter
 
 # 從 config 模組匯入我們需要的設定
-from config import OLLAMA_BASE_URL, OLLAMA_VISION_MODEL, DEFAULT_MODEL
+from config import OLLAMA_BASE_URL, OLLAMA_VISION_MODEL, DEFAULT_MODEL, OLLAMA_KEEP_ALIVE
 
-def image_to_base64(raw: bytes):
-    return base64.b64encode(raw).decode()
+# 預先編譯的正規表達式，避免每次呼叫都查詢 re 的內部快取
+_THINK_RE = re.compile(r'<think>.*?</think>\s*', re.DOTALL)
+_THINK_OPEN, _THINK_CLOSE = '<think>', '</think>'
+
+# Ollama 的生成 (含載入模型) 可能遠超過工具呼叫的 15 秒上限，因此只限制建立 socket 的時間，不限制總長；
+# 用 sock_connect 而不是 connect，等待連線池空位的時間不算在內，同時串流的人多時只會排隊而不會逾時
+OLLAMA_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=5)
+
+# 串流回覆時，兩次編輯訊息之間的最短間隔（秒）
+STREAM_EDIT_INTERVAL = 1.5
+# 兩次編輯之間至少要新增的字數，太少就不值得多打一次 API
+STREAM_EDIT_MIN_CHARS = 80
+# 被 Telegram 限流後，為了送出最終內容最多願意等待的秒數；
+# 預設一次只處理一個更新，等太久會讓所有使用者的訊息都跟著卡住
+RETRY_AFTER_MAX_WAIT = 30
+
+def image_to_base64(raw: bytes | bytearray):
+    return base64.b64encode(raw).decode('ascii')
+
+def strip_think(text: str) -> str:
+    """移除模型輸出中的 <think>...</think> 區塊；沒有標籤時直接略過正規表達式"""
+    if '<think>' in text:
+        text = _THINK_RE.sub('', text)
+    return text.strip()
+
+def _parse_ollama_line(line: bytes) -> str | None:
+    """解析 Ollama 串流中的一行 JSON，回傳其中的文字片段；空行、結束訊息或無法解析時回傳 None"""
+    if not line.strip():
+        return None
+    try:
+        # orjson 直接吃 bytes，省去 decode 與純 Python 的 json 解析
+        chunk = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        logging.warning("無法解析的 JSON 片段: %s", line)
+        return None
+    if chunk.get("done") is False:
+        return chunk.get("message", {}).get("content", "")
+    return None
 
 # ✨ V6 核心改造：ask_ollama 現在是一個強大的非同步產生器
 async def ask_ollama_stream(ctx: ContextTypes.DEFAULT_TYPE, msgs: list, image_b64: str = None):
@@ -34,173 +73,497 @@ async def ask_ollama_stream(ctx: ContextTypes.DEFAULT_TYPE, msgs: list, image_b6
         "model": model_to_use,
         "messages": msgs,
         "stream": True, # ✨ 開啟串流模式
+        # ✨ 讓模型與它的 KV cache 常駐，下一輪相同的 persona + 歷史前綴就不必重新計算
+        "keep_alive": OLLAMA_KEEP_ALIVE,
         "options": { "temperature": 0.5 }
     }
     if image_b64: payload["images"] = [image_b64]
 
     url = f"{OLLAMA_BASE_URL}/chat"
     try:
-        async with session.post(url, json=payload) as response:
+        async with session.post(url, json=payload, timeout=OLLAMA_TIMEOUT) as response:
             if response.status != 200:
                 error_body = await response.text()
-                logging.error(f"Ollama API 錯誤: {response.status}, {error_body}")
+                logging.error("Ollama API 錯誤: %s, %s", response.status, error_body)
                 yield "⚠️ API 回應錯誤"
                 return
 
-            # 逐行讀取串流回應
-            async for line in response.content:
-                if line:
-                    try:
-                        chunk = json.loads(line.decode('utf-8'))
-                        if chunk.get("done") is False:
-                            content = chunk.get("message", {}).get("content", "")
-                            yield content
-                    except json.JSONDecodeError:
-                        logging.warning(f"無法解析的 JSON 片段: {line}")
-                        continue
+            # 以區塊讀取串流回應，再自行切出 NDJSON 的每一行：一次 await 可處理多個 token
+            buf = b""
+            async for data in response.content.iter_chunked(4096):
+                lines = (buf + data).split(b"\n")
+                buf = lines.pop() # 最後一段可能是還沒收完的半行，留到下一個區塊
+                for line in lines:
+                    content = _parse_ollama_line(line)
+                    if content is not None:
+                        yield content
+            content = _parse_ollama_line(buf)
+            if content is not None:
+                yield content
     except Exception as e:
-        logging.exception(f"ask_ollama_stream 未知錯誤: {e}")
+        logging.exception("ask_ollama_stream 未知錯誤: %s", e)
         yield f"⚠️ 發生未知錯誤"
 
+class _ToolCallWatcher:
+    """
+    逐片段判斷模型的回應是否「以一個已完整的工具呼叫 JSON 開頭，且後面接的已經是別的內容」。
+    每個字元只掃描一次 (思考區塊只保留可能是 </think> 開頭的尾巴，JSON 以 _BracketScanner 累進配對)，
+    長篇思考或多個工具呼叫也不會因為每個片段都重掃整段而退化成 O(n²)。
+    feed() 回傳 True 代表可以提早結束生成；False 代表不必再檢查 (一般聊天或無法提早判斷)；None 代表還需要更多內容。
+    """
+
+    def __init__(self):
+        self._phase = "start" # start -> (think -> start) -> json -> after
+        self._pending = ""
+        self._json_parts: list[str] = []
+        self._scanner = _BracketScanner()
+
+    def feed(self, chunk: str) -> bool | None:
+        self._pending += chunk
+        while True:
+            if self._phase == "start":
+                text = self._pending.lstrip()
+                self._pending = text
+                if not text or (len(text) < len(_THINK_OPEN) and _THINK_OPEN.startswith(text)):
+                    return None # 還沒有內容，或可能是被切斷的 <think>
+                if text.startswith(_THINK_OPEN):
+                    self._phase, self._pending = "think", text[len(_THINK_OPEN):]
+                elif text[0] in '{[':
+                    self._phase = "json"
+                else:
+                    return False # 一般聊天回覆，照常等它生成完
+            elif self._phase == "think":
+                idx = self._pending.find(_THINK_CLOSE)
+                if idx == -1:
+                    self._pending = self._pending[-(len(_THINK_CLOSE) - 1):] # 只留可能是被切斷標籤的尾巴
+                    return None # 還在思考區塊中
+                self._phase, self._pending = "start", self._pending[idx + len(_THINK_CLOSE):]
+            elif self._phase == "json":
+                text, self._pending = self._pending, ""
+                self._json_parts.append(text)
+                self._scanner.feed(text)
+                end = self._scanner.pairs.get(0)
+                if end is None:
+                    # 開頭的括號被當成不成對而丟棄時，永遠不會收尾，交給完整回應處理
+                    return None if self._scanner.stack else False
+                body = ''.join(self._json_parts)
+                candidate = body[:end + 1]
+                if 'tool_name' not in candidate or extract_json_from_text(candidate) is None:
+                    return False # 只是剛好以括號開頭的一般文字
+                self._phase, self._pending = "after", body[end + 1:]
+            else:
+                rest = self._pending.lstrip()
+                self._pending = rest
+                if not rest:
+                    return None # 還不知道後面會不會接著第二個工具呼叫
+                # 後面緊接著另一個 JSON (或逗號) 時可能是多個工具呼叫，保守起見讓它生成完
+                return False if rest[0] in '{[,' else True
+
 # ✨ V6 新增：一個非串流的版本，供內部工具判斷使用
 async def ask_ollama_once(
-    ctx: ContextTypes.DEFAULT_TYPE, msgs: list, image_b64: str | None = None
+    ctx: ContextTypes.DEFAULT_TYPE, msgs: list, image_b64: str | None = None, stop_after_json: bool = False
 ) -> str:
     """
     向 Ollama API 發送一次性請求，獲取完整回應。
     主要用於需要完整 JSON 的函式呼叫判斷。
+    stop_after_json=True 時，一旦回應以完整的工具呼叫 JSON 開頭、後面又開始生成其他文字，
+    就立刻中止串流並關閉連線，不再等模型把多餘的內容生成完。
     """
-    full_response = ""
-    async for chunk in ask_ollama_stream(ctx, msgs, image_b64=image_b64):
-        full_response += chunk
-    return full_response
+    parts: list[str] = []
+    watcher = _ToolCallWatcher() if stop_after_json else None
+    async with contextlib.aclosing(ask_ollama_stream(ctx, msgs, image_b64=image_b64)) as stream:
+        async for chunk in stream:
+            parts.append(chunk)
+            if watcher is not None:
+                done = watcher.feed(chunk)
+                if done:
+                    logging.info("已取得完整的工具呼叫，提早結束模型生成。")
+                    break
+                if done is False:
+                    watcher = None
+    return ''.join(parts)
+
+
+async def coalesce_stream(generator, interval: float = STREAM_EDIT_INTERVAL, min_chars: int = STREAM_EDIT_MIN_CHARS):
+    """
+    將上游產生器的零碎片段合併：距離上次產出超過 interval 秒、且新增了至少 min_chars 個字時，
+    才產出一次目前累積的完整文字（串流結束時一定會產出最終內容），
+    讓消費者每次產出只需要編輯一次訊息，不會因為過多的 editMessageText 而被 Telegram 限流。
+    """
+    parts: list[str] = []
+    total_len = 0
+    emitted_len = 0
+    last_emit_time = 0
+    loop = asyncio.get_running_loop() # 只取一次，迴圈內直接使用 loop.time()
+
+    async for chunk in generator:
+        parts.append(chunk)
+        total_len += len(chunk)
+        current_time = loop.time()
+
+        if current_time - last_emit_time > interval and total_len - emitted_len >= min_chars:
+            # 只在真的要產出時才組字串，並把已組好的內容收成一段，避免下次重複拼接
+            text = ''.join(parts)
+            parts = [text]
+            yield text
+            emitted_len = total_len
+            last_emit_time = current_time
+
+    # 串流結束後，確保最後的完整內容一定會被產出
+    if total_len > emitted_len:
+        yield ''.join(parts)
 
 
 # ✨ V6 新增：優雅的訊息編輯器，實現打字效果
 async def stream_and_edit_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE, response_generator):
     """
-    V2: 接收一個回應產生器，實現串流打字效果，並修復重複發送的 Bug。
+    V4: 接收一個回應產生器，經由 coalesce_stream 合併後，每次產出只編輯一次訊息；
+    遇到 Telegram 限流 (RetryAfter) 時暫停編輯，等懲罰期過後再補上最終內容。
     """
     message_to_edit = None
     full_response = ""
     buffer = ""
-    last_edit_time = 0
     edit_success = True # ✨ 新增一個旗標來追蹤編輯狀態
 
+    placeholder = "..."
+    last_sent = placeholder # 訊息一送出就顯示佔位文字，最終內容剛好相同時也不必再編輯
+
+    async def edit(text: str):
+        nonlocal message_to_edit, last_sent
+        # Telegram 會去掉頭尾空白；內容與上次送出的相同時直接略過，
+        # 不必花一次 API 往返才從 "Message is not modified" 得知
+        text = text.strip()
+        if not text or text == last_sent:
+            return
+        message_to_edit = await ctx.bot.edit_message_text(
+            text=text, 
+            chat_id=message_to_edit.chat_id, 
+            message_id=message_to_edit.message_id
+        )
+        last_sent = text
+
     try:
         # 第一次一定先發送訊息
-        message_to_edit = await update.message.reply_text("...")
-
-        async for chunk in response_generator:
-            buffer += chunk
-            current_time = asyncio.get_event_loop().time()
-
-            if current_time - last_edit_time > 0.75 and buffer: # 稍微拉長編輯間隔
-                try:
-                    await ctx.bot.edit_message_text(
-                        text=buffer, 
-                        chat_id=message_to_edit.chat_id, 
-                        message_id=message_to_edit.message_id
-                    )
-                    last_edit_time = current_time
-                except BadRequest as e:
-                    # 如果是因為訊息未修改而報錯，就忽略它，這是正常現象
-                    if "Message is not modified" not in str(e):
-                        raise e # 如果是其他錯誤，就拋出讓外層捕捉
-        
-        # 串流結束後，確保最後的完整內容被更新
+        message_to_edit = await update.message.reply_text(placeholder)
+
+        loop = asyncio.get_running_loop()
+        rate_limited_until = 0
+        edit_pending = False # 是否有因為限流而尚未送出的內容
+
+        async for text in coalesce_stream(response_generator):
+            buffer = text
+            if loop.time() < rate_limited_until:
+                edit_pending = True
+                continue
+            try:
+                await edit(buffer)
+                edit_pending = False
+            except RetryAfter as e:
+                logging.warning("編輯訊息被限流，%s 秒內暫停編輯。", e.retry_after)
+                rate_limited_until = loop.time() + e.retry_after
+                edit_pending = True
+
         full_response = buffer
-        if message_to_edit.text != full_response:
-            await ctx.bot.edit_message_text(
-                text=full_response, 
-                chat_id=message_to_edit.chat_id, 
-                message_id=message_to_edit.message_id
-            )
-
-    except (Forbidden, BadRequest) as e:
-        logging.warning(f"編輯訊息時發生錯誤，將直接發送最終結果: {e}")
+
+        # 串流結束時若還有被限流擋下的內容，等懲罰期結束 (最多 RETRY_AFTER_MAX_WAIT 秒) 後補上最終版本；
+        # 懲罰期比這更長時就放棄最終編輯，提早送出只會再被限流，改用 reply 補救也會撞上同一個聊天室的限制
+        if edit_pending:
+            remaining = rate_limited_until - loop.time()
+            if remaining > RETRY_AFTER_MAX_WAIT:
+                logging.warning("限流還要 %.0f 秒才結束，略過最終的訊息編輯。", remaining)
+            else:
+                await asyncio.sleep(max(0, remaining))
+                await edit(full_response)
+
+    except (Forbidden, BadRequest, RetryAfter) as e:
+        logging.warning("編輯訊息時發生錯誤，將直接發送最終結果: %s", e)
         edit_success = False # ✨ 標記編輯失敗
     
     # ✨ 如果在整個編輯過程中發生了無法忽略的錯誤，
     # 且我們有最終的完整回覆，就用 reply_safely 發送一次作為補救。
     if not edit_success and full_response:
-        await reply_safely(update, full_response)
+        try:
+            await reply_safely(update, full_response)
+        except RetryAfter as e:
+            logging.warning("補發最終結果時也被限流 (%s 秒)，放棄補發。", e.retry_after)
     # ✨ 如果編輯過程是成功的，就不再需要做任何事。
 
     # 回傳完整的訊息，以便存入歷史
     # 如果 full_response 是空的（例如，產生器完全沒東西），就用 buffer 的內容
     return full_response or buffer
 
+def _marker_prefix_len(text: str, marker: str) -> int:
+    """text 的結尾與 marker 的開頭重疊了幾個字（標籤可能被切在兩個片段之間）"""
+    for n in range(min(len(text), len(marker) - 1), 0, -1):
+        if text.endswith(marker[:n]):
+            return n
+    return 0
+
 async def filter_stream(generator):
     """
-    一個非同步產生器，接收另一個產生器，
-    並在產出內容前過濾掉 <think>...</think> 區塊。
+    一個非同步產生器，接收另一個產生器，即時過濾掉 <think>...</think> 區塊。
+    逐片段追蹤目前是否位於思考區塊內，乾淨的文字立刻往下游產出；
+    只保留一小段可能是「被切斷的標籤開頭」的尾巴，等下一個片段再判斷。
+    頭尾與 </think> 之後的空白處理方式與 strip_think 相同。
     """
-    full_response = ""
+    inside_think = False
+    carry = ""       # 尚未判斷完的尾巴
+    pending_ws = ""  # 暫存的空白，後面接著正文時才產出（避免結尾多出空白）
+    skip_ws = True   # 開頭與 </think> 之後的空白直接丟棄
+
+    def visible(text: str) -> str:
+        nonlocal pending_ws, skip_ws
+        if skip_ws:
+            text = text.lstrip()
+            if not text:
+                return ""
+            skip_ws = False
+        body = text.rstrip()
+        if not body:
+            pending_ws += text
+            return ""
+        out = pending_ws + body
+        pending_ws = text[len(body):]
+        return out
+
     async for chunk in generator:
-        full_response += chunk
+        carry += chunk
+        out = []
+        while True:
+            marker = _THINK_CLOSE if inside_think else _THINK_OPEN
+            idx = carry.find(marker)
+            if idx == -1:
+                break
+            if not inside_think:
+                out.append(visible(carry[:idx]))
+            carry = carry[idx + len(marker):]
+            inside_think = not inside_think
+            if not inside_think:
+                skip_ws = True
 
-    # 等到整個回應都接收完畢後，再一次性過濾
-    # 這樣可以避免 <think> 標籤被切斷導致過濾失敗
-    cleaned_response = re.sub(r'<think>.*?</think>', '', full_response, flags=re.DOTALL).strip()
-    
-    # 將過濾後的乾淨文字，重新變成一個產生器並回傳
-    # 這裡我們用一個簡單的方式模擬串流，讓打字效果依然存在
-    for i in range(0, len(cleaned_response), 10):
-        yield cleaned_response[i:i+10]
-        await asyncio.sleep(0.01)
+        keep = _marker_prefix_len(carry, marker)
+        if not inside_think:
+            out.append(visible(carry[:len(carry) - keep]))
+        carry = carry[len(carry) - keep:]
+
+        text = ''.join(out)
+        if text:
+            yield text
 
+    # 串流結束：剩下的尾巴已不可能是標籤；沒有閉合的思考區塊則整段捨棄
+    if not inside_think:
+        text = visible(carry)
+        if text:
+            yield text
+
+
+# MarkdownV2 中永遠必須跳脫的字元，以及成對出現才合法的格式標記
+_MDV2_ALWAYS_ESCAPE = frozenset('[]()>#+-=|{}.!')
+_MDV2_PAIRED = '_*~'
+
+def _is_valid_mdv2(text: str) -> bool:
+    """
+    保守地在本地檢查文字能否被 Telegram 以 MarkdownV2 解析：
+    程式碼區塊外的保留字元都必須以 \\ 跳脫，_ * ~ 等格式標記必須成對。
+    只要有疑慮就回傳 False，直接改送純文字，省下一次注定失敗的 API 往返。
+    """
+    counts = dict.fromkeys(_MDV2_PAIRED, 0)
+    in_code = False
+    escaped = False
+    for ch in text:
+        if escaped:
+            escaped = False
+        elif ch == '\\':
+            escaped = True
+        elif ch == '`':
+            in_code = not in_code
+        elif in_code:
+            continue
+        elif ch in _MDV2_ALWAYS_ESCAPE:
+            return False
+        elif ch in counts:
+            counts[ch] += 1
+    return not in_code and not escaped and all(n % 2 == 0 for n in counts.values())
 
 async def reply_safely(update: Update, text: str):
-    """安全地回覆訊息，優先嘗試 MarkdownV2，失敗則改用純文字"""
+    """安全地回覆訊息：本地檢查可用 MarkdownV2 時才使用，否則直接送純文字"""
     if not text or not text.strip():
         logging.warning("嘗試發送空訊息，已略過。")
         return
     try:
-        await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+        if _is_valid_mdv2(text):
+            # 預檢已過濾掉大部分問題，解析失敗的 except 只是最後的保險
+            await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+        else:
+            await update.message.reply_text(text)
     except telegram.error.BadRequest as e:
         if "can't parse entities" in str(e).lower():
-            logging.warning(f"MarkdownV2 解析失敗 ({e})，自動改用純文字。")
+            logging.warning("MarkdownV2 解析失敗 (%s)，自動改用純文字。", e)
             try:
                 await update.message.reply_text(text)
             except Exception as final_e:
-                logging.error(f"純文字模式發送也失敗: {final_e}")
+                logging.error("純文字模式發送也失敗: %s", final_e)
                 await update.message.reply_text("抱歉，我好像說錯話了 >.<")
         else:
-            logging.error(f"非預期的 BadRequest: {e}")
+            logging.error("非預期的 BadRequest: %s", e)
             await update.message.reply_text("抱歉，回覆時發生問題。")
 
+# 單引號前面是這些字元時才可能是 Python 風格字串的開頭
+_SINGLE_QUOTE_OPENERS = frozenset('{[:,')
+
+class _BracketScanner:
+    """
+    可以分段餵入的括號配對器：找出每個 { / [ 對應的收尾位置 (記錄在 pairs)，略過字串 (單引號或雙引號) 內的括號。
+    字串狀態只在括號內追蹤，且遇到換行就重置，避免散文中的引號打亂配對。
+    單引號只有緊接在 { [ : , 之後 (可隔著空白) 才視為字串開頭，
+    像 [Lala's note] 這種散文裡的撇號不會吃掉後面的內容。
+    """
+
+    def __init__(self):
+        self.pairs: dict[int, int] = {}
+        self.stack: list[tuple[int, str]] = []
+        self.pos = 0 # 已掃描的總字數，下一段文字從這個位置接續編號
+        self._quote = None
+        self._escaped = False
+        self._prev = '' # 字串外上一個非空白字元
+
+    def feed(self, text: str) -> None:
+        pairs, stack = self.pairs, self.stack
+        quote, escaped, prev = self._quote, self._escaped, self._prev
+        for i, ch in enumerate(text, self.pos):
+            if quote:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == quote or ch == '\n':
+                    quote = None
+                    prev = ch
+                continue
+            if ch.isspace():
+                continue
+            if ch == '"':
+                quote = ch if stack else None
+            elif ch == "'":
+                quote = ch if stack and prev in _SINGLE_QUOTE_OPENERS else None
+            elif ch == '{' or ch == '[':
+                stack.append((i, ch))
+            elif ch == '}' or ch == ']':
+                opener = '{' if ch == '}' else '['
+                # 丟掉堆疊頂端不成對的開括號，直到找到同類型的為止
+                while stack and stack[-1][1] != opener:
+                    stack.pop()
+                if stack:
+                    pairs[stack.pop()[0]] = i
+            prev = ch
+        self.pos += len(text)
+        self._quote, self._escaped, self._prev = quote, escaped, prev
+
+def _match_brackets(text: str) -> dict[int, int]:
+    """單次線性掃描，找出每個 { / [ 對應的收尾位置 (規則見 _BracketScanner)"""
+    scanner = _BracketScanner()
+    scanner.feed(text)
+    return scanner.pairs
+
+def _single_to_double_quotes(text: str) -> str:
+    """
+    把 Python 風格的單引號字串改寫成 JSON 的雙引號字串。
+    只翻轉作為字串邊界的單引號，雙引號字串內的撇號 (例如 "it's") 維持原樣。
+    """
+    out: list[str] = []
+    quote = None
+    escaped = False
+    for ch in text:
+        if quote is None:
+            if ch == "'":
+                out.append('"')
+                quote = "'"
+            else:
+                if ch == '"':
+                    quote = '"'
+                out.append(ch)
+        elif escaped:
+            if quote == "'" and ch == "'":
+                out[-1] = "'" # \' 不是合法的 JSON 跳脫，改回單純的撇號
+            else:
+                out.append(ch)
+            escaped = False
+        elif ch == '\\':
+            out.append(ch)
+            escaped = True
+        elif ch == quote:
+            out.append('"')
+            quote = None
+        elif ch == '"':
+            out.append('\\"') # 單引號字串內的雙引號需要跳脫
+        else:
+            out.append(ch)
+    return ''.join(out)
+
+def _looks_like_python_call(candidate: str) -> bool:
+    """候選區段是否可能是 Python 風格 (單引號、True/False/None) 的工具呼叫，值得走備援解析"""
+    if 'tool_name' not in candidate:
+        return False
+    return "'" in candidate or 'True' in candidate or 'False' in candidate or 'None' in candidate
+
+def _loads_lenient(candidate: str):
+    """嚴格 JSON 解析失敗時的備援：先試單引號轉換，再試 Python 字面值；都失敗回傳 None"""
+    try:
+        return json.loads(_single_to_double_quotes(candidate))
+    except json.JSONDecodeError:
+        pass
+    try:
+        obj = ast.literal_eval(candidate)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    return obj if isinstance(obj, (dict, list)) else None
+
 # ✨ 使用您提出的、最健壯的 V4 版本，並修正單引號問題
 def extract_json_from_text(text: str) -> str | None:
     """
-    V4.1: 使用 json.JSONDecoder.raw_decode 逐字掃描，並預處理單引號問題。
+    V6: 先以線性的括號配對找出候選區段，只在成對的括號範圍內呼叫一次 raw_decode，
+    不再從每個字元重試，長篇且充滿括號的輸出也不會退化成 O(n²)。
+    標準 JSON 直接取用原文；Python 風格 (單引號、True/None) 的候選才走備援解析，
+    並重新序列化為標準 JSON，因此回傳值一定能被 json.loads 解析。
     """
-    text_no_think = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
-    
-    # 預處理：將 Python 風格的單引號替換為 JSON 標準的雙引號
-    # 為了避免錯誤替換字串內容中的單引號，這是一個簡化的權衡
-    # 更複雜的作法需要完整的 Python AST 解析器
-    text_to_decode = text_no_think.replace("'", '"')
+    text_no_think = _THINK_RE.sub('', text)
+    pairs = _match_brackets(text_no_think)
 
     decoder = json.JSONDecoder()
-    i, n = 0, len(text_to_decode)
     slices: list[str] = []
+    consumed = 0
+    lenient_tried = 0 # 已嘗試過備援解析的候選結尾
 
-    while i < n:
-        ch = text_to_decode[i]
-        if ch in '{[':
-            try:
-                obj, end = decoder.raw_decode(text_to_decode[i:])
-                slices.append(text_to_decode[i : i + end])
-                i += end
-            except json.JSONDecodeError:
-                i += 1
-                continue
-        else:
-            i += 1
+    for start in sorted(pairs):
+        if start < consumed:
+            continue # 已包含在前一個成功解析的區段內
+        end = pairs[start] + 1
+        candidate = text_no_think[start:end]
+        try:
+            # 只解碼這個候選區段：解析失敗時 JSONDecodeError 會計算錯誤位置之前的行數，
+            # 對整段原文解碼的話，每個失敗的候選都要重新數一次前綴，又會退化成 O(n²)
+            obj, length = decoder.raw_decode(candidate)
+            slices.append(candidate[:length])
+            consumed = start + length
+            continue
+        except json.JSONDecodeError:
+            pass
+        # 備援解析很昂貴：只給看起來像 Python 風格工具呼叫的候選，
+        # 且外層候選試過之後，不再對它內層的候選重試 (避免括號很多的回覆退化成 O(n·深度))
+        if start < lenient_tried or not _looks_like_python_call(candidate):
+            continue
+        lenient_tried = end
+        obj = _loads_lenient(candidate)
+        if obj is None:
+            continue # 這個候選失敗，改試下一個 (可能是內層的) 候選
+        try:
+            slices.append(json.dumps(obj, ensure_ascii=False))
+        except (TypeError, ValueError):
+            continue
+        consumed = end
 
     if not slices:
         return None
     if len(slices) == 1:
         return slices[0]
-    return '[' + ','.join(slices) + ']'
\ No newline at end of file
+    return '[' + ','.join(slices) + ']'